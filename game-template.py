@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
+import collections
 import json
+import os
 import pygame
 
 pygame.mixer.pre_init()
@@ -16,6 +18,25 @@ GRID_SIZE = 64
 # Options
 sound_on = True
 
+# Development
+WATCH_LEVELS = False # Apply changes to the current level file while playing
+LEVEL_WATCH_INTERVAL = 500 # milliseconds between checks for level file changes
+
+# Audio
+NUM_SOUND_CHANNELS = 8
+
+# Memory
+MEMORY_BUDGET = 256 * 1024 * 1024 # bytes of surfaces and sounds, None for no limit
+MEMORY_BUDGET_ACTION = "warn" # "warn" to print a warning, "refuse" to not load levels that go over budget
+
+# Loading
+LOAD_TIME_PER_FRAME = 10 # milliseconds of level loading done each frame on the loading screen
+LOAD_ENTITIES_PER_STEP = 100
+
+# Caching
+SCENE_CACHE_SIZE = 3 # Most recently played levels kept in memory. The title scene is always kept.
+ENTITY_POOL_SIZE = 500 # Unused entities kept per entity type
+
 # Level files
 levels = ["levels/world-1.json",
           "levels/world-2.json",
@@ -26,6 +47,7 @@ TRANSPARENT = (0, 0, 0, 0)
 DARK_BLUE = (16, 86, 103)
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
+GRAY = (128, 128, 128)
 
 # Fonts
 FONT_SM = pygame.font.Font("assets/fonts/minya_nouvelle_bd.ttf", 32)
@@ -105,14 +127,174 @@ class ImageUtil():
             for x in range(x_start, x_end, x_step):
                 surface.blit(img, [x, y])
 
+class MemoryBudgetError(Exception):
+    pass
+
+class MemoryTracker():
+    '''
+    Tallies approximate bytes used by surfaces and sounds, grouped by category
+    (an asset type or a level) and then by name within the category. Entities,
+    including those held in the EntityPool, aren't counted since they share
+    their images with the asset tables and own no surfaces themselves.
+    '''
+    def __init__(self, budget=MEMORY_BUDGET, action=MEMORY_BUDGET_ACTION):
+        self.budget = budget
+        self.action = action
+        self.categories = {}
+
+    def surface_bytes(surface):
+        return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+    def sound_bytes(sound):
+        frequency, size, channels = pygame.mixer.get_init()
+
+        return int(sound.get_length() * frequency) * channels * abs(size) // 8
+
+    def track(self, category, name, num_bytes):
+        self.categories.setdefault(category, {})[name] = num_bytes
+
+    def track_surfaces(self, category, name, surfaces):
+        unique = {id(s): s for s in surfaces} # Don't count shared surfaces twice
+        num_bytes = sum(MemoryTracker.surface_bytes(s) for s in unique.values())
+        self.track(category, name, num_bytes)
+
+    def untrack(self, category):
+        self.categories.pop(category, None)
+
+    def category_total(self, category):
+        return sum(self.categories.get(category, {}).values())
+
+    def total(self):
+        return sum(self.category_total(c) for c in self.categories)
+
+    def check(self, num_bytes, description):
+        '''
+        Call before allocating num_bytes. Warns or raises MemoryBudgetError,
+        depending on the budget action, if the allocation would go over budget.
+        '''
+        if self.budget != None and self.total() + num_bytes > self.budget:
+            message = "{} needs {:.1f} MB, {:.1f} MB of {:.1f} MB budget already used".format(
+                      description, num_bytes / 2**20, self.total() / 2**20, self.budget / 2**20)
+
+            if self.action == "refuse":
+                raise MemoryBudgetError(message)
+            else:
+                print("Warning: over memory budget. " + message)
+
+    def report(self):
+        print("Memory usage")
+
+        for category in sorted(self.categories):
+            print("  {:<32}{:>10.1f} KB".format(category, self.category_total(category) / 1024))
+
+            for name, num_bytes in sorted(self.categories[category].items()):
+                print("    {:<30}{:>10.1f} KB".format(name, num_bytes / 1024))
+
+        print("  {:<32}{:>10.1f} MB".format("Total", self.total() / 2**20))
+
+        if self.budget != None:
+            print("  {:<32}{:>10.1f} MB".format("Budget", self.budget / 2**20))
+
+memory_tracker = MemoryTracker()
+
+class SoundEffect():
+    '''
+    A sound that isn't decoded until it is first played or preloaded. When all
+    channels are busy, an effect can take over a channel playing an effect of
+    equal or lower priority. min_interval (ms) and max_voices keep bursts of the
+    same effect, like collecting a row of coins, from piling up.
+    '''
+    def __init__(self, file_path, priority=0, min_interval=0, max_voices=1):
+        self.file_path = file_path
+        self.priority = priority
+        self.min_interval = min_interval
+        self.max_voices = max_voices
+
+        self.sound = None
+        self.last_played = None
+
+    def load(self):
+        if self.sound == None:
+            self.sound = pygame.mixer.Sound(self.file_path)
+            memory_tracker.track("sounds", self.file_path, MemoryTracker.sound_bytes(self.sound))
+
+        return self.sound
+
+class ChannelPool():
+    '''
+    A fixed set of mixer channels shared by all sound effects.
+    '''
+    def __init__(self, num_channels=NUM_SOUND_CHANNELS):
+        pygame.mixer.set_num_channels(num_channels)
+
+        self.channels = [pygame.mixer.Channel(i) for i in range(num_channels)]
+        self.effects = [None] * num_channels
+        self.start_times = [0] * num_channels
+
+    def find_channel(self, effect):
+        '''
+        Returns the index of the channel an effect should play on, or None if
+        the effect should be dropped.
+        '''
+        free = []
+        same_effect = []
+        stealable = []
+
+        for i, channel in enumerate(self.channels):
+            if not channel.get_busy():
+                free.append(i)
+            elif self.effects[i] == effect:
+                same_effect.append(i)
+            elif self.effects[i] != None and self.effects[i].priority <= effect.priority:
+                stealable.append(i)
+
+        if len(same_effect) >= effect.max_voices:
+            return min(same_effect, key=lambda i: self.start_times[i])
+        elif len(free) > 0:
+            return free[0]
+        elif len(stealable) > 0:
+            return min(stealable, key=lambda i: (self.effects[i].priority, self.start_times[i]))
+
+        return None
+
+    def play(self, effect, loops=0, maxtime=0, fade_ms=0):
+        now = pygame.time.get_ticks()
+
+        if effect.last_played != None and now - effect.last_played < effect.min_interval:
+            return
+
+        i = self.find_channel(effect)
+
+        if i != None:
+            self.channels[i].play(effect.load(), loops, maxtime, fade_ms)
+            self.effects[i] = effect
+            self.start_times[i] = now
+            effect.last_played = now
+
+sound_channels = ChannelPool()
+
 class SoundUtil():
+    current_music = None
+
     def toggle_mute(self):
         global sound_on
         sound_on = not sound_on
 
-    def play_sound(sound, loops=0, maxtime=0, fade_ms=0):
+    def play_sound(effect, loops=0, maxtime=0, fade_ms=0):
         if sound_on:
-            sound.play(loops, maxtime, fade_ms)
+            sound_channels.play(effect, loops, maxtime, fade_ms)
+
+    def preload_sounds(effects):
+        for effect in effects.values():
+            effect.load()
+
+    def load_music(file_path):
+        '''
+        Loads music for streaming. Does nothing if the file is already loaded.
+        '''
+        if file_path != SoundUtil.current_music:
+            pygame.mixer.music.load(file_path)
+            SoundUtil.current_music = file_path
 
     def play_music():
         if sound_on:
@@ -138,7 +320,16 @@ item_images = {"Coin": ImageUtil.load_scaled_image("assets/items/coin.png"),
 hero_images = {"run": [ImageUtil.load_scaled_image("assets/hero/adventurer_walk1.png"),
                         ImageUtil.load_scaled_image("assets/hero/adventurer_walk2.png")],
                "jump": ImageUtil.load_scaled_image("assets/hero/adventurer_jump.png"),
-               "idle": ImageUtil.load_scaled_image("assets/hero/adventurer_idle.png")}
+               "idle": ImageUtil.load_scaled_image("assets/hero/adventurer_idle.png"),
+               "fall": ImageUtil.load_scaled_image("assets/hero/adventurer_fall.png"),
+               "hurt": ImageUtil.load_scaled_image("assets/hero/adventurer_hurt.png"),
+               "duck": ImageUtil.load_scaled_image("assets/hero/adventurer_duck.png"),
+               "climb": [ImageUtil.load_scaled_image("assets/hero/adventurer_climb1.png"),
+                         ImageUtil.load_scaled_image("assets/hero/adventurer_climb2.png")],
+               "swim": [ImageUtil.load_scaled_image("assets/hero/adventurer_swim1.png"),
+                        ImageUtil.load_scaled_image("assets/hero/adventurer_swim2.png")],
+               "cheer": [ImageUtil.load_scaled_image("assets/hero/adventurer_cheer1.png"),
+                         ImageUtil.load_scaled_image("assets/hero/adventurer_cheer2.png")]}
 
 enemy_images = {"Bear": [ImageUtil.load_scaled_image("assets/enemies/bear-0.png"),
                          ImageUtil.load_scaled_image("assets/enemies/bear-1.png"),
@@ -146,13 +337,97 @@ enemy_images = {"Bear": [ImageUtil.load_scaled_image("assets/enemies/bear-0.png"
                 "Monster": [ImageUtil.load_scaled_image("assets/enemies/monster-1.png"),
                             ImageUtil.load_scaled_image("assets/enemies/monster-2.png")]}
 
-sound_effects = {'jump': pygame.mixer.Sound("assets/sounds/jump.wav"),
-                 'coin': pygame.mixer.Sound("assets/sounds/pickup_coin.wav"),
-                 'powerup': pygame.mixer.Sound("assets/sounds/powerup.wav"),
-                 'hurt': pygame.mixer.Sound("assets/sounds/hurt.ogg"),
-                 'die': pygame.mixer.Sound("assets/sounds/death.wav"),
-                 'levelup': pygame.mixer.Sound("assets/sounds/level_up.wav"),
-                 'gameover': pygame.mixer.Sound("assets/sounds/game_over.wav")}
+sound_effects = {'jump': SoundEffect("assets/sounds/jump.wav", priority=1),
+                 'coin': SoundEffect("assets/sounds/pickup_coin.wav", priority=0, min_interval=50, max_voices=2),
+                 'powerup': SoundEffect("assets/sounds/powerup.wav", priority=2),
+                 'hurt': SoundEffect("assets/sounds/hurt.ogg", priority=2),
+                 'die': SoundEffect("assets/sounds/death.wav", priority=3),
+                 'levelup': SoundEffect("assets/sounds/level_up.wav", priority=3),
+                 'gameover': SoundEffect("assets/sounds/game_over.wav", priority=3)}
+
+# Animations
+class AnimationUtil():
+    def build_animations(table, faces_right=True):
+        '''
+        Expands a table of {state: (images, ticks_per_frame)} into a lookup of
+        {(state, facing_right): (frames, ticks_per_frame)}. Flipped frames are
+        made once here instead of per entity. Set faces_right to False if the
+        source images face left.
+        '''
+        animations = {}
+
+        for state, (images, ticks) in table.items():
+            if not isinstance(images, list):
+                images = [images]
+
+            flipped = ImageUtil.reverse_images(images)
+
+            if len(images) == 1:
+                ticks = 0 # Single frames never need to advance
+
+            animations[state, faces_right] = (tuple(images), ticks)
+            animations[state, not faces_right] = (tuple(flipped), ticks)
+
+        return animations
+
+class Animator():
+    '''
+    Steps an entity through a precomputed animation table. The entity's image is
+    only reassigned when the state, direction, or frame actually changes.
+    '''
+    def __init__(self, entity, animations, state, facing_right=True):
+        self.entity = entity
+        self.animations = animations
+        self.state = None
+        self.facing_right = facing_right
+
+        self.play(state, facing_right)
+
+    def play(self, state, facing_right, restart=False):
+        if state != self.state or restart:
+            self.state = state
+            self.index = 0
+            self.ticks = 0
+        elif facing_right == self.facing_right:
+            return
+
+        self.facing_right = facing_right
+        self.frames, self.ticks_per_frame = self.animations[state, facing_right]
+        self.entity.image = self.frames[self.index]
+
+    def tick(self):
+        if self.ticks_per_frame > 0:
+            self.ticks += 1
+
+            if self.ticks == self.ticks_per_frame:
+                self.ticks = 0
+                self.index = (self.index + 1) % len(self.frames)
+                self.entity.image = self.frames[self.index]
+
+# States that Hero.animation_states doesn't choose (climb, swim, etc.) can be
+# played by setting hero.action from any hero behavior.
+hero_animations = AnimationUtil.build_animations({"idle": (hero_images['idle'], 0),
+                                                  "run": (hero_images['run'], 5), # Works well with 2 images, try lower number if more frames are in animation
+                                                  "jump": (hero_images['jump'], 0),
+                                                  "fall": (hero_images['fall'], 0),
+                                                  "hurt": (hero_images['hurt'], 0),
+                                                  "duck": (hero_images['duck'], 0),
+                                                  "climb": (hero_images['climb'], 10),
+                                                  "swim": (hero_images['swim'], 10),
+                                                  "cheer": (hero_images['cheer'], 10)})
+
+enemy_animations = {"Bear": AnimationUtil.build_animations({"walk": (enemy_images['Bear'], 15)}, faces_right=False),
+                    "Monster": AnimationUtil.build_animations({"walk": (enemy_images['Monster'], 15)}, faces_right=False)}
+
+# Asset memory
+memory_tracker.track_surfaces("images", "block_images", block_images.values())
+memory_tracker.track_surfaces("images", "item_images", item_images.values())
+memory_tracker.track_surfaces("images", "hero_animations",
+                              [f for frames, ticks in hero_animations.values() for f in frames])
+
+for kind, animations in enemy_animations.items():
+    memory_tracker.track_surfaces("enemy animations", kind,
+                                  [f for frames, ticks in animations.values() for f in frames])
 
 # Game entities
 class Entity(pygame.sprite.Sprite):
@@ -167,6 +442,19 @@ class Entity(pygame.sprite.Sprite):
         self.vy = 0
         self.vx = 0
 
+    def recycle(self, image, x, y):
+        '''
+        Reinitializes a pooled entity so it can be reused at a new position.
+        Takes the same arguments as the constructor.
+        '''
+        self.image = image
+        self.rect.size = self.image.get_size()
+        self.rect.x = x
+        self.rect.y = y
+
+        self.vy = 0
+        self.vx = 0
+
     def is_near(self, other, distance=SCREEN_WIDTH):
         '''
         Returns true if entity is within a certain distance from another.
@@ -183,19 +471,19 @@ class Block(Entity):
         super().__init__(image, x, y)
 
 class Hero(Entity):
-    def __init__(self, all_images):
-        super().__init__(all_images['idle'])
-
-        self.image_idle_right = all_images['idle']
-        self.image_idle_left = ImageUtil.reverse_image(self.image_idle_right)
-        self.images_run_right = all_images['run']
-        self.images_run_left = ImageUtil.reverse_images(self.images_run_right)
-        self.image_jump_right = all_images['jump']
-        self.image_jump_left = ImageUtil.reverse_image(self.image_jump_right)
-        
-        self.running_images = self.images_run_right
-        self.run_index = 0
-        self.steps = 0
+    # (condition, state) pairs checked in order when hero.action isn't set.
+    # The first state whose condition is true is shown.
+    animation_states = [(lambda hero: hero.invincibility > 0, "hurt"),
+                        (lambda hero: not hero.on_ground and hero.vy > 0, "fall"),
+                        (lambda hero: not hero.on_ground, "jump"),
+                        (lambda hero: hero.vx != 0, "run"),
+                        (lambda hero: True, "idle")]
+
+    def __init__(self, animations):
+        super().__init__(animations['idle', True][0][0])
+
+        self.animator = Animator(self, animations, "idle")
+        self.action = None # Animation state that overrides animation_states, like "climb"
 
         self.speed = 5
         self.jump_power = 20
@@ -203,10 +491,13 @@ class Hero(Entity):
         self.facing_right = True
         self.on_ground = True
     
+        self.max_hearts = 3
+        self.new_game()
+
+    def new_game(self):
         self.score = 0
         self.lives = 3
-        self.hearts = 3
-        self.max_hearts = 3
+        self.hearts = self.max_hearts
         self.invincibility = 0
         
     def run_left(self):
@@ -294,28 +585,16 @@ class Hero(Entity):
         self.lives -= 1
         
     def set_image(self):
-        if self.on_ground:
-            if self.vx != 0:
-                if self.facing_right:
-                    self.running_images = self.images_run_right
-                else:
-                    self.running_images = self.images_run_left
-
-                self.steps = (self.steps + 1) % self.speed # Works well with 2 images, try lower number if more frames are in animation
-
-                if self.steps == 0:
-                    self.run_index = (self.run_index + 1) % len(self.running_images)
-                    self.image = self.running_images[self.run_index]
-            else:
-                if self.facing_right:
-                    self.image = self.image_idle_right
-                else:
-                    self.image = self.image_idle_left
-        else:
-            if self.facing_right:
-                self.image = self.image_jump_right
-            else:
-                self.image = self.image_jump_left
+        state = self.action
+
+        if state == None:
+            for condition, animation_state in self.animation_states:
+                if condition(self):
+                    state = animation_state
+                    break
+
+        self.animator.play(state, self.facing_right)
+        self.animator.tick()
                 
     def update(self, level):
         self.apply_gravity(level)
@@ -342,13 +621,13 @@ class Hero(Entity):
         self.hearts = self.max_hearts
         self.invincibility = 0
         self.facing_right = True
+        self.action = None
         
 class Enemy(Entity):
-    def __init__(self, all_images, x, y):
-        super().__init__(all_images[0], x, y)
+    def __init__(self, animations, x, y):
+        super().__init__(animations['walk', False][0][0], x, y)
 
-        self.left_images = all_images
-        self.right_images = ImageUtil.reverse_images(all_images)
+        self.animator = Animator(self, animations, "walk", False)
         
         self.start_x = x
         self.start_y = y
@@ -356,6 +635,15 @@ class Enemy(Entity):
         self.start_vy = 0
 
         self.reset()
+
+    def recycle(self, animations, x, y):
+        super().recycle(animations['walk', False][0][0], x, y)
+
+        self.animator.animations = animations
+        self.start_x = x
+        self.start_y = y
+
+        self.reset()
         
     def reverse(self):
         '''
@@ -404,16 +692,8 @@ class Enemy(Entity):
             self.vy = 0
 
     def set_image(self):
-        if self.vx < 0:
-            self.current_images = self.left_images
-        else:
-            self.current_images = self.right_images
-            
-        if self.steps == 0:
-            self.image = self.current_images[self.image_index]
-            self.image_index = (self.image_index + 1) % len(self.current_images)
-
-        self.steps = (self.steps + 1) % 15 # Nothing significant about 15. It just seems to work okay.
+        self.animator.play("walk", self.vx >= 0)
+        self.animator.tick()
 
     def update(self, level):
         self.apply_gravity(level)
@@ -427,22 +707,19 @@ class Enemy(Entity):
         self.vx = self.start_vx
         self.vy = self.start_vy
         
-        self.current_images = self.left_images
-        self.image_index = 0
-        self.image = self.current_images[self.image_index]
-        self.steps = 0
+        self.animator.play("walk", False, restart=True)
         
 class Bear(Enemy):
     '''
     Bears behave like default enemy. No overrides needed.
     '''
 
-    def __init__(self, all_images, x, y):
-        super().__init__(all_images, x, y)
+    def __init__(self, animations, x, y):
+        super().__init__(animations, x, y)
 
 class Monster(Enemy):
-    def __init__(self, all_images, x, y):
-        super().__init__(all_images, x, y)
+    def __init__(self, animations, x, y):
+        super().__init__(animations, x, y)
 
     def check_platform_edges(self, level):
         '''
@@ -510,13 +787,63 @@ class Flag(Item):
     def apply(self, character):
         SoundUtil.play_sound(sound_effects['levelup'])
 
+class EntityPool():
+    '''
+    Holds on to entities from unloaded levels so that loading another level can
+    reuse them instead of allocating new sprites.
+    '''
+    def __init__(self, max_per_type=ENTITY_POOL_SIZE):
+        self.max_per_type = max_per_type
+        self.free = {}
+
+    def acquire(self, entity_type, *args):
+        free = self.free.get(entity_type)
+
+        if free:
+            entity = free.pop()
+            entity.recycle(*args)
+        else:
+            entity = entity_type(*args)
+
+        return entity
+
+    def release(self, entity):
+        entity.kill()
+        free = self.free.setdefault(type(entity), [])
+
+        if len(free) < self.max_per_type:
+            free.append(entity)
+
+entity_pool = EntityPool()
+
+# Input
+class InputSnapshot():
+    '''
+    Everything a scene needs to know about input for one frame. keys_down holds
+    the keys pressed this frame, pressed_keys is the state of all keys, and
+    events holds any other events the active scene asked for in event_types.
+    '''
+    def __init__(self, pressed_keys, keys_down, events):
+        self.pressed_keys = pressed_keys
+        self.keys_down = keys_down
+        self.events = events
+
 # Scenes
 class Scene():
+    # Event types besides QUIT and KEYDOWN that this scene wants to receive.
+    # All other events are blocked at the queue while the scene is active.
+    event_types = []
+
     def __init__(self):
         self.next_scene = self
+        self.key_handlers = {} # {key: function to call when the key is pressed}
 
-    def process_input(self, events, pressed_keys):
-        raise NotImplementedError
+    def process_input(self, snapshot):
+        for key in snapshot.keys_down:
+            handler = self.key_handlers.get(key)
+
+            if handler != None:
+                handler()
 
     def update(self):
         raise NotImplementedError
@@ -527,18 +854,36 @@ class Scene():
     def change_to_scene(self, next_scene):
         self.next_scene = next_scene
 
+    def restart(self):
+        self.change_to_scene( scene_cache.get_or_create('title', TitleScene) )
+
+    def enter(self):
+        '''
+        Called when a cached scene is made active again.
+        '''
+        self.next_scene = self
+
+    def unload(self):
+        '''
+        Called when a scene is dropped from the scene cache.
+        '''
+        pass
+
     def terminate(self):
         self.next_scene = None
 
 class TitleScene(Scene):
     def __init__(self):
         super().__init__()
-        self.hero = Hero(hero_images) # Initialize a hero before starting GameScene scenes
+        self.hero = Hero(hero_animations) # Initialize a hero before starting GameScene scenes
 
-    def process_input(self, events, pressed_keys):
-        for event in events:
-            if event.type == pygame.KEYDOWN:
-                self.change_to_scene( GameScene(self.hero, 0) )
+    def enter(self):
+        super().enter()
+        self.hero.new_game()
+
+    def process_input(self, snapshot):
+        if len(snapshot.keys_down) > 0:
+            self.change_to_scene( scene_cache.get_level(self.hero, 0) )
 
     def update(self):
         '''
@@ -550,9 +895,75 @@ class TitleScene(Scene):
         screen.fill(BLACK)
         TextUtil.display_message(screen, "Name of Game", "Ready?!!! Press any key to start.")
 
-class GameScene(Scene):
+class LoadingScene(Scene):
+    '''
+    Loads a GameScene a few steps per frame so the window keeps pumping events
+    and shows progress, then switches to the finished GameScene.
+    '''
     def __init__(self, hero, level_num):
         super().__init__()
+        self.level_num = level_num
+        self.game_scene = GameScene(hero, level_num, load_now=False)
+        self.loader = self.load_steps()
+        self.progress = 0
+        self.failed = False
+
+    def load_steps(self):
+        # Unload old levels on the first update rather than in __init__ since
+        # the scene that made this one may still be drawing them this frame.
+        scene_cache.make_room(('game', self.level_num))
+        yield 0
+
+        yield from self.game_scene.load_level_steps()
+
+    def update(self):
+        if self.next_scene == None:
+            return # Quit while loading
+
+        stop_time = pygame.time.get_ticks() + LOAD_TIME_PER_FRAME
+
+        while not self.failed and pygame.time.get_ticks() < stop_time:
+            try:
+                self.progress = next(self.loader)
+            except StopIteration:
+                scene_cache.add(('game', self.level_num), self.game_scene)
+                self.change_to_scene(self.game_scene)
+                SoundUtil.play_music()
+                break
+            except MemoryBudgetError as e:
+                print(e)
+                self.failed = True
+                self.key_handlers = {pygame.K_r: self.restart}
+
+    def render(self, surface):
+        surface.fill(BLACK)
+
+        if self.failed:
+            TextUtil.display_message(surface, "Level too big", "Press 'R' to restart.")
+            return
+
+        TextUtil.display_message(surface, "Loading...")
+
+        w = SCREEN_WIDTH // 2
+        h = 24
+        x = SCREEN_WIDTH / 2 - w / 2
+        y = SCREEN_HEIGHT * 2 / 3
+
+        pygame.draw.rect(surface, GRAY, [x, y, w, h])
+        pygame.draw.rect(surface, WHITE, [x, y, w * self.progress, h])
+
+class GameScene(Scene):
+    entity_categories = ['blocks', 'items', 'flag', 'enemies']
+
+    # Level settings that require the layers to be rebuilt when they change
+    layer_settings = ['width', 'height',
+                      'background-color', 'background-img', 'background-repeat-x',
+                      'background-repeat-y', 'background-scale-to-screen-height',
+                      'scenery-img', 'scenery-repeat-x', 'scenery-repeat-y',
+                      'scenery-scale-to-screen-height']
+
+    def __init__(self, hero, level_num, load_now=True):
+        super().__init__()
 
         self.hero = hero
         self.level_num = level_num
@@ -563,6 +974,10 @@ class GameScene(Scene):
         self.starting_items = []
         self.starting_flag = []
         self.starting_enemies = []
+        self.entity_specs = {} # {(category, x, y, kind): [entities]}, used to apply level file changes
+
+        self.level_mtime = None
+        self.last_watch_check = 0
         
         self.blocks = pygame.sprite.Group()
         self.items = pygame.sprite.Group()
@@ -572,15 +987,84 @@ class GameScene(Scene):
         self.active_sprites = pygame.sprite.Group()
         self.inactive_sprites = pygame.sprite.Group()
 
-        self.load_level()
+        self.key_handlers = {pygame.K_SPACE: self.on_space_pressed,
+                             pygame.K_p: self.toggle_pause,
+                             pygame.K_c: self.complete_level, # temp stuff for scene testing
+                             pygame.K_m: memory_tracker.report}
+
+        if load_now:
+            self.load_level()
 
     def load_level(self):
+        for progress in self.load_level_steps():
+            pass
+
+        SoundUtil.play_music()
+
+    def read_level_data(self):
         data_file = levels[self.level_num]
+        self.level_mtime = os.path.getmtime(data_file)
 
         with open(data_file, 'r') as f:
             data = f.read()
 
-        map_data = json.loads(data)
+        return json.loads(data)
+
+    def load_level_steps(self):
+        '''
+        Loads the level a piece at a time, yielding the fraction completed after
+        each piece. LoadingScene uses this to keep the window responsive while
+        large levels load.
+        '''
+        map_data = self.read_level_data()
+
+        entities = [(category, item) for category in self.entity_categories
+                                     for item in map_data[category]]
+
+        steps_done = 1
+        total_steps = 5 + (len(entities) + LOAD_ENTITIES_PER_STEP - 1) // LOAD_ENTITIES_PER_STEP
+        yield steps_done / total_steps
+
+        self.check_layer_memory(map_data)
+        self.apply_settings(map_data)
+
+        layers = {}
+
+        for layer_done in self.build_layers_steps(map_data, layers):
+            steps_done += 1
+            yield steps_done / total_steps
+
+        self.set_layers(layers)
+
+        self.music = map_data['music']
+        SoundUtil.load_music(self.music)
+        SoundUtil.preload_sounds(sound_effects)
+        print(self.music)
+
+        steps_done += 1
+        yield steps_done / total_steps
+
+        for i in range(0, len(entities), LOAD_ENTITIES_PER_STEP):
+            for category, item in entities[i:i + LOAD_ENTITIES_PER_STEP]:
+                entity = self.load_entity(category, item)
+
+                if entity != None:
+                    self.add_entity(category, entity)
+
+                    # draw inactive layer as blocks load since it isn't redrawn on each iteration of game loop
+                    if category in ['blocks', 'flag']:
+                        self.inactive_layer.blit(entity.image, entity.rect)
+
+            steps_done += 1
+            yield steps_done / total_steps
+
+        # Music starts when the level is shown, not here
+        self.active_sprites.add(self.hero)
+        self.hero.reset(self.start_x, self.start_y)
+        yield 1.0
+
+    def apply_settings(self, map_data):
+        self.settings = {k: v for k, v in map_data.items() if k not in self.entity_categories}
 
         self.width = map_data['width'] * GRID_SIZE
         self.height = map_data['height'] * GRID_SIZE
@@ -591,13 +1075,32 @@ class GameScene(Scene):
         self.gravity = map_data['gravity']
         self.terminal_velocity = map_data['terminal-velocity']
 
-        self.background_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.scenery_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.inactive_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.active_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
+    def check_layer_memory(self, map_data):
+        '''
+        Checks the memory budget for this level's layers. LoadingScene has the
+        scene cache make room first, so any level it unloads is already gone.
+        '''
+        data_file = levels[self.level_num]
+
+        layer_bytes = map_data['width'] * map_data['height'] * GRID_SIZE * GRID_SIZE * 4 # 32 bit layers
+        memory_tracker.check(4 * layer_bytes, data_file)
+
+    def build_layers_steps(self, map_data, layers):
+        '''
+        Makes new layers in the layers dict and paints the background and
+        scenery, yielding after each is painted. The scene's own layers are
+        left alone until set_layers is called.
+        '''
+        width = map_data['width'] * GRID_SIZE
+        height = map_data['height'] * GRID_SIZE
+
+        for name in ['background_layer', 'scenery_layer', 'inactive_layer', 'active_layer']:
+            layers[name] = pygame.Surface([width, height], pygame.SRCALPHA, 32)
+
+        background_layer = layers['background_layer']
 
         if map_data['background-color'] != "":
-            self.background_layer.fill(map_data['background-color'])
+            background_layer.fill(map_data['background-color'])
 
         if map_data['background-img'] != "":
             background_img = ImageUtil.load_image(map_data['background-img'])
@@ -608,7 +1111,9 @@ class GameScene(Scene):
             repeat_x = map_data['background-repeat-x']
             repeat_y = map_data['background-repeat-y']
             
-            ImageUtil.tile_to_surface(background_img, self.background_layer, repeat_x, repeat_y)
+            ImageUtil.tile_to_surface(background_img, background_layer, repeat_x, repeat_y)
+
+        yield
 
         if map_data['scenery-img'] != "":
             scenery_img = ImageUtil.load_image(map_data['scenery-img'])
@@ -619,42 +1124,219 @@ class GameScene(Scene):
             repeat_x = map_data['scenery-repeat-x']
             repeat_y = map_data['scenery-repeat-y']
             
-            ImageUtil.tile_to_surface(scenery_img, self.background_layer, repeat_x, repeat_y)
+            ImageUtil.tile_to_surface(scenery_img, background_layer, repeat_x, repeat_y)
 
-        pygame.mixer.music.load(map_data['music'])
-        print(map_data['music'])
-        
-        for item in map_data['blocks']:
-            x, y, kind = item[0] * GRID_SIZE, item[1] * GRID_SIZE, item[2]
+        yield
+
+    def set_layers(self, layers):
+        data_file = levels[self.level_num]
+
+        for name, layer in layers.items():
+            setattr(self, name, layer)
+            memory_tracker.track(data_file, name, MemoryTracker.surface_bytes(layer))
+
+    def starting_list(self, category):
+        return {'blocks': self.starting_blocks,
+                'items': self.starting_items,
+                'flag': self.starting_flag,
+                'enemies': self.starting_enemies}[category]
+
+    def load_entity(self, category, item):
+        x, y, kind = item[0] * GRID_SIZE, item[1] * GRID_SIZE, item[2]
+        entity = None
+
+        if category == 'blocks':
             img = block_images[kind]
-            self.starting_blocks.append( Block(img, x, y) )
+            entity = entity_pool.acquire(Block, img, x, y)
 
-        for item in map_data['items']:
-            x, y, kind = item[0] * GRID_SIZE, item[1] * GRID_SIZE, item[2]            
+        elif category == 'items':
             img = item_images[kind]
 
             if kind == "Coin":
-                self.starting_items.append( Coin(img, x, y) )
+                entity = entity_pool.acquire(Coin, img, x, y)
             elif kind == "Heart":
-                self.starting_items.append( Heart(img, x, y) )
+                entity = entity_pool.acquire(Heart, img, x, y)
             elif kind == "OneUp":
-                self.starting_items.append( OneUp(img, x, y) )
+                entity = entity_pool.acquire(OneUp, img, x, y)
 
-        for item in map_data['flag']:
-            x, y, kind = item[0] * GRID_SIZE, item[1] * GRID_SIZE, item[2]            
+        elif category == 'flag':
             img = item_images[kind]
-            self.starting_flag.append( Flag(img, x, y) )
+            entity = entity_pool.acquire(Flag, img, x, y)
 
-        for item in map_data['enemies']:
-            x, y, kind = item[0] * GRID_SIZE, item[1] * GRID_SIZE, item[2]            
-            imgs = enemy_images[kind]
+        elif category == 'enemies':
+            animations = enemy_animations[kind]
 
             if kind == "Bear":
-                self.starting_enemies.append( Bear(imgs, x, y) )
+                entity = entity_pool.acquire(Bear, animations, x, y)
             elif kind == "Monster":
-                self.starting_enemies.append( Monster(imgs, x, y) )
+                entity = entity_pool.acquire(Monster, animations, x, y)
+
+        if entity != None:
+            self.starting_list(category).append(entity)
+            self.entity_specs.setdefault((category,) + tuple(item[:3]), []).append(entity)
+
+        return entity
+
+    def add_entity(self, category, entity):
+        if category == 'blocks':
+            self.blocks.add(entity)
+            self.inactive_sprites.add(entity)
+        elif category == 'flag':
+            self.flag.add(entity)
+            self.inactive_sprites.add(entity)
+        elif category == 'items':
+            self.items.add(entity)
+            self.active_sprites.add(entity)
+        elif category == 'enemies':
+            self.enemies.add(entity)
+            self.active_sprites.add(entity)
+
+    def check_level_file(self):
+        now = pygame.time.get_ticks()
+
+        if now - self.last_watch_check >= LEVEL_WATCH_INTERVAL:
+            self.last_watch_check = now
+
+            try:
+                changed = os.path.getmtime(levels[self.level_num]) != self.level_mtime
+            except OSError:
+                changed = False # Editors sometimes remove the file briefly while saving
+
+            if changed:
+                self.reload_level()
+
+    def validate_level_data(self, map_data):
+        '''
+        Raises ValueError if level data can't be applied, so a file that is
+        still being edited leaves the current level untouched.
+        '''
+        def is_number(value):
+            return isinstance(value, (int, float)) and not isinstance(value, bool)
 
-        self.reset()
+        if not isinstance(map_data, dict):
+            raise ValueError("level data is not an object")
+
+        required = self.layer_settings + ['start', 'gravity', 'terminal-velocity', 'music'] + self.entity_categories
+
+        for key in required:
+            if key not in map_data:
+                raise ValueError("missing '" + key + "'")
+
+        for key in ['width', 'height', 'gravity', 'terminal-velocity']:
+            if not is_number(map_data[key]):
+                raise ValueError("'" + key + "' is not a number")
+
+        for key in ['width', 'height']:
+            if map_data[key] <= 0:
+                raise ValueError("'" + key + "' must be greater than 0")
+
+        start = map_data['start']
+
+        if not (isinstance(start, list) and len(start) == 2 and is_number(start[0]) and is_number(start[1])):
+            raise ValueError("'start' is not an [x, y] pair")
+
+        for key in ['background-img', 'scenery-img', 'music']:
+            if map_data[key] != "" and not os.path.isfile(map_data[key]):
+                raise ValueError("'" + key + "' file not found: " + str(map_data[key]))
+
+        kinds = {'blocks': block_images,
+                 'items': item_images,
+                 'flag': item_images,
+                 'enemies': enemy_animations}
+
+        for category, known_kinds in kinds.items():
+            if not isinstance(map_data[category], list):
+                raise ValueError("'" + category + "' is not a list")
+
+            for item in map_data[category]:
+                if not (isinstance(item, list) and len(item) >= 3 and is_number(item[0]) and is_number(item[1])):
+                    raise ValueError("bad entry in '" + category + "': " + str(item))
+                elif not isinstance(item[2], str) or item[2] not in known_kinds:
+                    raise ValueError("unknown kind in '" + category + "': " + str(item))
+
+    def reload_level(self):
+        '''
+        Applies changes in the level file without resetting the hero. Only
+        entities that were added or removed are created or released, and only
+        the parts of the inactive layer they cover are redrawn. Nothing changes
+        unless the file is valid and any new layers were built successfully.
+        '''
+        new_layers = {}
+
+        try:
+            map_data = self.read_level_data()
+            self.validate_level_data(map_data)
+
+            rebuild_layers = any(map_data.get(k) != self.settings.get(k) for k in self.layer_settings)
+
+            if rebuild_layers:
+                self.check_layer_memory(map_data)
+
+                for layer_done in self.build_layers_steps(map_data, new_layers):
+                    pass
+
+        except (OSError, ValueError, MemoryBudgetError, pygame.error) as e:
+            print("Couldn't reload " + levels[self.level_num] + ": " + str(e))
+            return
+
+        music_changed = map_data['music'] != self.music
+
+        self.apply_settings(map_data)
+
+        new_specs = collections.Counter((category,) + tuple(item[:3]) for category in self.entity_categories
+                                                                      for item in map_data[category])
+        old_specs = collections.Counter({spec: len(entities) for spec, entities in self.entity_specs.items()})
+
+        dirty_rects = []
+
+        for spec, count in (old_specs - new_specs).items():
+            category = spec[0]
+            entities = self.entity_specs[spec]
+
+            for i in range(count):
+                entity = entities.pop()
+                self.starting_list(category).remove(entity)
+
+                if entity in self.inactive_sprites:
+                    dirty_rects.append(entity.rect.copy())
+
+                entity_pool.release(entity)
+
+            if len(entities) == 0:
+                del self.entity_specs[spec]
+
+        for spec, count in (new_specs - old_specs).items():
+            category = spec[0]
+
+            for i in range(count):
+                entity = self.load_entity(category, list(spec[1:]))
+
+                if entity != None:
+                    self.add_entity(category, entity)
+
+                    if category in ['blocks', 'flag']:
+                        dirty_rects.append(entity.rect.copy())
+
+        if rebuild_layers:
+            self.set_layers(new_layers)
+            self.inactive_sprites.draw(self.inactive_layer)
+        else:
+            for rect in dirty_rects:
+                self.inactive_layer.set_clip(rect)
+                self.inactive_layer.fill(TRANSPARENT, rect)
+
+                for sprite in self.inactive_sprites:
+                    if sprite.rect.colliderect(rect):
+                        self.inactive_layer.blit(sprite.image, sprite.rect)
+
+                self.inactive_layer.set_clip(None)
+
+        if music_changed:
+            self.music = map_data['music']
+            SoundUtil.load_music(self.music)
+            SoundUtil.play_music()
+
+        print("reloaded " + levels[self.level_num])
 
     def reset(self):
         self.blocks.add(self.starting_blocks)
@@ -669,13 +1351,37 @@ class GameScene(Scene):
 
         for e in self.enemies:
             e.reset()
-        
-        # draw inactive layer here since we don't need to redraw on each iteration of game loop
-        self.inactive_sprites.draw(self.inactive_layer)
 
         SoundUtil.play_music()
         print("reset")
 
+    def enter(self):
+        super().enter()
+        self.completed = False
+        self.paused = False
+
+        self.active_sprites.empty()
+        SoundUtil.load_music(self.music)
+        self.reset()
+
+    def unload(self):
+        memory_tracker.untrack(levels[self.level_num])
+
+        # Let the layers be freed. An unloaded scene is never shown again.
+        self.background_layer = None
+        self.scenery_layer = None
+        self.inactive_layer = None
+        self.active_layer = None
+
+        for entity in self.starting_blocks + self.starting_items + self.starting_flag + self.starting_enemies:
+            entity_pool.release(entity)
+
+        self.starting_blocks = []
+        self.starting_items = []
+        self.starting_flag = []
+        self.starting_enemies = []
+        self.entity_specs = {}
+
     def display_stats(self, surface):
         hearts_text = FONT_SM.render("Hearts: " + str(self.hero.hearts), 1, WHITE)
         lives_text = FONT_SM.render("Lives: " + str(self.hero.lives), 1, WHITE)
@@ -695,43 +1401,44 @@ class GameScene(Scene):
 
         return x, 0
     
-    def process_input(self, events, pressed_keys):
-        for event in events:
-            if event.type == pygame.KEYDOWN:
-                if self.completed:
-                    if event.key == pygame.K_SPACE:
-                        # advance to next scene
-                        self.level_num += 1
-
-                        if self.level_num < len(levels):
-                            self.change_to_scene( GameScene(self.hero, self.level_num) )
-                        else:
-                            self.change_to_scene( VictoryScene(self.hero) )
-
-                else:
-                    if event.key == pygame.K_p:
-                        # toggle paused state
-                        self.paused = not self.paused
-
-                    if not self.paused:
-                        # deal with actions bound to game events such as jumping
-                        if event.key == pygame.K_SPACE:
-                            self.hero.jump(self)
-
-                        # temp stuff for scene testing
-                        if event.key == pygame.K_c:
-                            self.completed = True
+    def on_space_pressed(self):
+        if self.completed:
+            # advance to next scene
+            next_level = self.level_num + 1
+
+            if next_level < len(levels):
+                self.change_to_scene( scene_cache.get_level(self.hero, next_level) )
+            else:
+                self.change_to_scene( VictoryScene(self.hero) )
+
+        elif not self.paused:
+            # deal with actions bound to game events such as jumping
+            self.hero.jump(self)
+
+    def toggle_pause(self):
+        if not self.completed:
+            self.paused = not self.paused
+
+    def complete_level(self):
+        if not (self.completed or self.paused):
+            self.completed = True
+
+    def process_input(self, snapshot):
+        super().process_input(snapshot)
 
         if not (self.completed or self.paused):
             # deal with actions bound to pressed keys
-            if pressed_keys[pygame.K_LEFT]:
+            if snapshot.pressed_keys[pygame.K_LEFT]:
                 self.hero.run_left()
-            elif pressed_keys[pygame.K_RIGHT]:
+            elif snapshot.pressed_keys[pygame.K_RIGHT]:
                 self.hero.run_right()
             else:
                 self.hero.stop()
 
     def update(self):
+        if WATCH_LEVELS:
+            self.check_level_file()
+
         if not (self.completed or self.paused):
             nearby_sprites = [s for s in self.active_sprites if s.is_near(self.hero)]
 
@@ -768,12 +1475,7 @@ class GameOverScene(Scene):
     def __init__(self, hero):
         super().__init__()
         self.hero = hero
-
-    def process_input(self, events, pressed_keys):
-        for event in events:
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_r:
-                    self.change_to_scene( TitleScene() )
+        self.key_handlers = {pygame.K_r: self.restart}
 
     def update(self):
         '''
@@ -789,12 +1491,7 @@ class VictoryScene(Scene):
     def __init__(self, hero):
         super().__init__()
         self.hero = hero
-
-    def process_input(self, events, pressed_keys):
-        for event in events:
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_r:
-                    self.change_to_scene( TitleScene() )
+        self.key_handlers = {pygame.K_r: self.restart}
 
     def update(self):
         '''
@@ -806,11 +1503,95 @@ class VictoryScene(Scene):
         surface.fill(BLACK)
         TextUtil.display_message(surface, "You win!", "Press 'R' to restart.")
 
+# Scene management
+class SceneCache():
+    '''
+    Keeps the most recently used scenes around so revisiting them skips
+    construction and loading. When there are more than max_scenes scenes, the
+    least recently used one is unloaded. Pinned scenes are never unloaded and
+    don't count toward max_scenes.
+    '''
+    def __init__(self, max_scenes=SCENE_CACHE_SIZE, pinned=('title',)):
+        self.max_scenes = max_scenes
+        self.pinned = pinned
+        self.scenes = collections.OrderedDict()
+
+    def unpinned_keys(self):
+        return [key for key in self.scenes if key not in self.pinned]
+
+    def make_room(self, key):
+        '''
+        Unloads scenes so that adding key won't go over max_scenes. Call this
+        before building a new scene so the old and new scenes aren't both in
+        memory at once.
+        '''
+        if key in self.scenes or key in self.pinned:
+            return
+
+        unpinned = self.unpinned_keys()
+
+        while len(unpinned) > 0 and len(unpinned) >= self.max_scenes:
+            old_scene = self.scenes.pop(unpinned.pop(0))
+            old_scene.unload()
+
+    def get(self, key):
+        scene = self.scenes.get(key)
+
+        if scene != None:
+            self.scenes.move_to_end(key)
+            scene.enter()
+
+        return scene
+
+    def add(self, key, scene):
+        self.scenes[key] = scene
+        self.scenes.move_to_end(key)
+
+        unpinned = self.unpinned_keys()
+
+        while len(unpinned) > self.max_scenes:
+            old_scene = self.scenes.pop(unpinned.pop(0))
+            old_scene.unload()
+
+    def get_or_create(self, key, scene_type, *args):
+        scene = self.get(key)
+
+        if scene == None:
+            scene = scene_type(*args)
+            self.add(key, scene)
+
+        return scene
+
+    def get_level(self, hero, level_num):
+        '''
+        Returns the cached GameScene for a level, or a LoadingScene that will
+        build it and add it to the cache.
+        '''
+        scene = self.scenes.get(('game', level_num))
+
+        if scene != None:
+            scene.hero = hero
+            return self.get(('game', level_num))
+
+        return LoadingScene(hero, level_num)
+
+scene_cache = SceneCache()
+
 # The actual game
 class MyGame():
+    # Event types that are never blocked
+    always_allowed = [pygame.QUIT, pygame.KEYDOWN]
+
     def __init__(self, start_scene):
         self.active_scene = start_scene
 
+        # Block everything else once up front. Blocking an event type drops any
+        # events of that type already in the queue, so after this only types
+        # that actually change between scenes are blocked or allowed.
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed(self.always_allowed)
+        self.allowed_types = set()
+
     def is_quit_event(self, event, pressed_keys):
         x_out = event.type == pygame.QUIT
 
@@ -819,21 +1600,45 @@ class MyGame():
 
         return x_out or ctrl_q
 
+    def set_allowed_events(self, scene):
+        wanted = set(scene.event_types) - set(self.always_allowed)
+        to_block = self.allowed_types - wanted
+        to_allow = wanted - self.allowed_types
+
+        if len(to_block) > 0:
+            pygame.event.set_blocked(list(to_block))
+        if len(to_allow) > 0:
+            pygame.event.set_allowed(list(to_allow))
+
+        self.allowed_types = wanted
+
+    def get_input(self):
+        # poll input states
+        pressed_keys = pygame.key.get_pressed()
+
+        # get events
+        keys_down = []
+        other_events = []
+        for event in pygame.event.get():
+            if self.is_quit_event(event, pressed_keys):
+                self.active_scene.terminate()
+            elif event.type == pygame.KEYDOWN:
+                keys_down.append(event.key)
+            elif event.type in self.allowed_types:
+                other_events.append(event) # Some SDL device events arrive even while blocked
+
+        return InputSnapshot(pressed_keys, keys_down, other_events)
+
     def run(self):
-        while self.active_scene != None:
-            # poll input states
-            pressed_keys = pygame.key.get_pressed()
+        allowed_for_scene = None
 
-            # get events
-            filtered_events = []
-            for event in pygame.event.get():
-                if self.is_quit_event(event, pressed_keys):
-                    self.active_scene.terminate()
-                else:
-                    filtered_events.append(event)
+        while self.active_scene != None:
+            if self.active_scene != allowed_for_scene:
+                self.set_allowed_events(self.active_scene)
+                allowed_for_scene = self.active_scene
 
             # game logic
-            self.active_scene.process_input(filtered_events, pressed_keys)
+            self.active_scene.process_input(self.get_input())
             self.active_scene.update()
             self.active_scene.render(screen)
             self.active_scene = self.active_scene.next_scene
@@ -843,6 +1648,6 @@ class MyGame():
             clock.tick(FPS)
 
 if __name__ == "__main__":
-    game = MyGame( TitleScene() )
+    game = MyGame( scene_cache.get_or_create('title', TitleScene) )
     game.run()
     pygame.quit()